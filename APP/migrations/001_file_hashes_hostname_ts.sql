@@ -0,0 +1,11 @@
+-- Per-host, newest-first index on file_hashes for existing databases
+-- (new databases get it from metadata.create_all in server.py).
+--
+--   psql "$DATABASE_URL" -f 001_file_hashes_hostname_ts.sql
+--
+-- No separate "id DESC" indexes are needed for /api/alerts and /api/logs:
+-- ORDER BY id DESC LIMIT n is already a backward scan of the primary-key index.
+-- CONCURRENTLY cannot run inside a transaction block, so don't wrap this file in BEGIN/COMMIT.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_file_hashes_hostname_ts
+    ON file_hashes (hostname, ts DESC);
@@ -0,0 +1,10 @@
+-- Optional: stop WAL-logging file_hashes (matches FILE_HASHES_UNLOGGED=true for new DBs).
+--
+--   psql "$DATABASE_URL" -f 002_file_hashes_unlogged.sql
+--
+-- Trade-off: an UNLOGGED table is emptied after a crash and is not replicated to standbys.
+-- That is acceptable for hash telemetry, which agents resend every scan. alerts must stay logged.
+-- SET UNLOGGED rewrites the table under an ACCESS EXCLUSIVE lock; run it in a quiet window.
+-- Revert with: ALTER TABLE file_hashes SET LOGGED;
+
+ALTER TABLE file_hashes SET UNLOGGED;
@@ -0,0 +1,22 @@
+-- One row per (hostname, file_path, sha256) in file_hashes for existing databases
+-- (new databases get the constraint from metadata.create_all in server.py).
+--
+--   psql "$DATABASE_URL" -f 003_file_hashes_unique.sql
+--
+-- Re-reported files are then skipped by INSERT ... ON CONFLICT DO NOTHING, so the row
+-- kept is the first sighting. Rows with a NULL sha256 (hash errors) never conflict.
+-- CONCURRENTLY cannot run inside a transaction block, so don't wrap this file in BEGIN/COMMIT.
+
+-- Drop existing duplicates, keeping the oldest row of each group.
+DELETE FROM file_hashes a
+    USING file_hashes b
+    WHERE a.hostname = b.hostname
+      AND a.file_path = b.file_path
+      AND a.sha256 = b.sha256
+      AND a.id > b.id;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_file_hashes_host_path_sha
+    ON file_hashes (hostname, file_path, sha256);
+
+ALTER TABLE file_hashes
+    ADD CONSTRAINT uq_file_hashes_host_path_sha UNIQUE USING INDEX uq_file_hashes_host_path_sha;
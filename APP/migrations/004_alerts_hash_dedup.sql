@@ -0,0 +1,12 @@
+-- Index for the repeat HASH-alert lookup in collect_hashes, for existing databases
+-- (new databases get it from metadata.create_all in server.py):
+--   WHERE hostname = ? AND category = 'HASH' AND sha256 IN (...) AND ts >= ?
+--
+--   psql "$DATABASE_URL" -f 004_alerts_hash_dedup.sql
+--
+-- Equality columns first, the ts range last. /api/alerts and /api/logs need nothing new:
+-- ORDER BY id DESC LIMIT n is a backward scan of the primary key (see 001).
+-- CONCURRENTLY cannot run inside a transaction block, so don't wrap this file in BEGIN/COMMIT.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_alerts_hash_dedup
+    ON alerts (hostname, category, sha256, ts);
@@ -6,6 +6,11 @@ logs(id, device_id, device_name, log_path, severity, created_at)
 - severity values used: "METRICS" / "HASH".
 - device_name = hostname from the agent; device_id left NULL (you can populate from the agent in the future).
 - created_at stored as naive UTC (matches 'timestamp without time zone').
+- DB/disk work is blocking, so endpoints are plain `def` and run in FastAPI's threadpool
+  (bounded by THREADPOOL_SIZE); only the request body is read on the event loop.
+- /api/metrics state is in-process: run one uvicorn worker per instance
+  (WEB_CONCURRENCY=1) or the dashboard sees only the hosts that hit its worker.
+- Oversized bodies are rejected with 413 (METRICS_MAX_BYTES / HASHES_MAX_BYTES).
 
 Other endpoints unchanged:
 - POST /collect-metrics  -> updates in-memory cache (for /api/metrics), creates RESOURCE alerts on thresholds
@@ -18,17 +23,44 @@ Other endpoints unchanged:
 """
 
 from __future__ import annotations
-from fastapi import FastAPI, HTTPException, Request, Query
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request, Query, Depends
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from datetime import datetime, timezone
-from typing import Optional, List, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Tuple, Dict
 from pathlib import Path
-from collections import deque
-import json
+from collections import deque, defaultdict
+from dataclasses import dataclass
+import csv
+import io
 import os, smtplib
-
+import numpy as np
+import orjson
+import queue
+import secrets
+import threading
+import time
+import zlib
+import anyio.to_thread
+import atexit
+import logging
+import logging.handlers
+
+# -------------------- logging --------------------
+# Request threads only enqueue records; a QueueListener thread does the formatting and
+# the (blocking) stderr write. LOG_LEVEL=DEBUG shows per-request detail.
+log = logging.getLogger("server_monitoring")
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+log.propagate = False
+_log_q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_q))
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_q, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)   # after every shutdown hook, so their messages land
 
 
 def send_critical_email() -> bool:
@@ -40,7 +72,7 @@ def send_critical_email() -> bool:
     to   = os.getenv("ALERT_EMAILS", user)
 
     if not (user and pwd and to):
-        print("[EMAIL] missing SMTP_USER/SMTP_PASS/ALERT_EMAILS")
+        log.warning("[EMAIL] missing SMTP_USER/SMTP_PASS/ALERT_EMAILS")
         return False
 
     
@@ -57,20 +89,31 @@ def send_critical_email() -> bool:
             s.sendmail(user, pwd, msg.encode("utf-8"))
         return True
     except Exception as e:
-        print(f"[EMAIL] send failed: {e}")
+        log.error("[EMAIL] send failed: %s", e)
         return False
 
 
 from sqlalchemy import (
     create_engine, MetaData, Table, Column, Integer, String, DateTime, BigInteger,
-    Float, select, desc, insert, UniqueConstraint, func
+    Float, select, desc, insert, UniqueConstraint, Index, func, inspect, text
 )
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import bindparam  
 
 # -------------------- FastAPI & static --------------------
-app = FastAPI(title="Server Monitoring API", version="7.1.0")
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (FastAPI's own ORJSONResponse is deprecated upstream).
+
+    Every timestamp we store is UTC, so naive datetimes are emitted with +00:00.
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NAIVE_UTC)
+
+app = FastAPI(title="Server Monitoring API", version="7.1.0", default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(GZipMiddleware, minimum_size=1024)   # responses; gzip'd request bodies: _json_body
 
 BASE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = BASE_DIR / "static"
@@ -79,6 +122,14 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+# Sync endpoints run on anyio's worker threads; bound the pool so a burst of agents
+# can't fan out into hundreds of threads all waiting on the DB pool.
+THREADPOOL_SIZE = int(os.environ.get("THREADPOOL_SIZE", "40"))
+
+@app.on_event("startup")
+def _limit_threadpool() -> None:
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
 @app.get("/")
 def index():
     idx = STATIC_DIR / "index.html"
@@ -90,7 +141,19 @@ def health() -> dict:
 
 # -------------------- DB setup --------------------
 DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///logs.db")
-engine = create_engine(DATABASE_URL, future=True)
+# Pool sizing: keep DB_POOL_SIZE + DB_MAX_OVERFLOW >= THREADPOOL_SIZE so request threads
+# don't queue on connection checkout (SQLite keeps SQLAlchemy's defaults). The pool is
+# per process: with WEB_CONCURRENCY workers the server may open up to
+# WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections, which must fit under
+# Postgres' max_connections.
+_POOL_KW = {} if DATABASE_URL.startswith("sqlite") else {
+    "pool_size": int(os.environ.get("DB_POOL_SIZE", "20")),
+    "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", "40")),
+    "pool_pre_ping": True,
+    # recycle before idle-timeouts on the server or a proxy drop the connection
+    "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+}
+engine = create_engine(DATABASE_URL, future=True, **_POOL_KW)
 metadata = MetaData()
 
 IOC_SCHEMA = os.environ.get("IOC_SCHEMA") or None
@@ -111,9 +174,15 @@ alerts = Table(
     Column("sha256", String(64), nullable=True),
     Column("cpu", Float, nullable=True),
     Column("ram_ratio", Float, nullable=True),
+    # repeat-alert lookup in collect_hashes; existing DBs: APP/migrations/004_alerts_hash_dedup.sql
+    Index("ix_alerts_hash_dedup", "hostname", "category", "sha256", "ts"),
 )
 
-# File hashes table (internal)
+# File hashes table (internal). It is an append-only firehose, so on Postgres it can be
+# created UNLOGGED (no WAL; truncated after a crash) with FILE_HASHES_UNLOGGED=true.
+# Existing DBs: APP/migrations/002_file_hashes_unlogged.sql. Never use this for alerts.
+FILE_HASHES_UNLOGGED = os.environ.get("FILE_HASHES_UNLOGGED", "false").lower() == "true"
+_FILE_HASH_KEY = ("hostname", "file_path", "sha256")
 file_hashes = Table(
     "file_hashes", metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
@@ -124,6 +193,11 @@ file_hashes = Table(
     Column("size", BigInteger, nullable=True),
     Column("mtime", DateTime(timezone=True), nullable=True),
     Column("error", String(512), nullable=True),
+    # per-host history lookups; existing DBs: APP/migrations/001_file_hashes_hostname_ts.sql
+    Index("ix_file_hashes_hostname_ts", "hostname", desc("ts")),
+    # re-reported files collapse to no-ops; existing DBs: APP/migrations/003_file_hashes_unique.sql
+    UniqueConstraint(*_FILE_HASH_KEY, name="uq_file_hashes_host_path_sha"),
+    prefixes=(["UNLOGGED"] if FILE_HASHES_UNLOGGED and engine.dialect.name == "postgresql" else []),
 )
 
 # -------------------- YOUR LOGS TABLE (matches screenshot) --------------------
@@ -155,6 +229,68 @@ else:
     )
     metadata.create_all(engine)
 
+def _ensure_file_hash_key() -> None:
+    """Give a pre-existing file_hashes table the unique key its ON CONFLICT inserts need.
+
+    create_all() never adds a constraint to a table that already exists, and without a
+    matching unique index every insert fails. Duplicates are dropped (oldest row kept) and
+    the index is built once. On a large Postgres table, apply
+    APP/migrations/003_file_hashes_unique.sql (CONCURRENTLY) before upgrading instead.
+    """
+    insp = inspect(engine)
+    key = list(_FILE_HASH_KEY)
+    if any(uc["column_names"] == key for uc in insp.get_unique_constraints("file_hashes")) or any(
+            ix.get("unique") and ix["column_names"] == key for ix in insp.get_indexes("file_hashes")):
+        return
+    log.warning("[DB] file_hashes has no unique (%s); removing duplicates and creating it", ", ".join(key))
+    cols = ", ".join(key)
+    with engine.begin() as conn:
+        dropped = conn.execute(text(
+            f"DELETE FROM file_hashes WHERE sha256 IS NOT NULL AND id NOT IN "
+            f"(SELECT MIN(id) FROM file_hashes WHERE sha256 IS NOT NULL GROUP BY {cols})"
+        )).rowcount
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_file_hashes_host_path_sha ON file_hashes ({cols})"))
+    log.warning("[DB] file_hashes unique index created; %s duplicate row(s) removed", dropped)
+
+_ensure_file_hash_key()
+
+# Batches at least this large go through COPY on Postgres; smaller ones use insert()
+COPY_MIN_ROWS = int(os.environ.get("COPY_MIN_ROWS", "100"))
+_USE_COPY = engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg2"
+# raw-cursor paths (COPY) raise driver errors that SQLAlchemy doesn't wrap
+_DBAPI_ERROR = getattr(engine.dialect.dbapi, "Error", SQLAlchemyError)
+
+# -------------------- statements (built once, reused per request) --------------------
+_INS_LOGS = insert(logs)
+_INS_ALERTS = insert(alerts)
+if engine.dialect.name in ("postgresql", "sqlite"):
+    _upsert = (postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert)(file_hashes)
+    _INS_FILE_HASHES = _upsert.on_conflict_do_nothing(index_elements=list(_FILE_HASH_KEY))
+else:
+    _INS_FILE_HASHES = insert(file_hashes)
+_SEL_ALERTS = select(
+    alerts.c.id, alerts.c.ts, alerts.c.hostname, alerts.c.category,
+    alerts.c.severity, alerts.c.label, alerts.c.description,
+    alerts.c.file_path, alerts.c.sha256, alerts.c.cpu, alerts.c.ram_ratio
+).order_by(desc(alerts.c.id)).limit(bindparam("lim"))
+_SEL_LOGS = select(
+    logs.c.id, logs.c.device_id, logs.c.device_name,
+    logs.c.log_path, logs.c.severity, logs.c.created_at
+).order_by(desc(logs.c.id)).limit(bindparam("lim"))
+# None when IOC_COL_SHA is missing on the IOC table (reported per request).
+# lower() stays on the column because the IOC feed is external.
+_ioc_col = suspicious_hashes.c.get(IOC_COL_SHA)
+_SEL_IOC_ALL = None if _ioc_col is None else select(func.lower(_ioc_col)).where(_ioc_col.is_not(None))
+
+# A file already alerted on within this window is not alerted again (0 = alert every time)
+HASH_ALERT_DEDUP_SECS = int(os.environ.get("HASH_ALERT_DEDUP_SECS", "86400"))
+_SEL_RECENT_HASH_ALERTS = select(alerts.c.sha256, alerts.c.file_path).where(
+    alerts.c.hostname == bindparam("hostname"),
+    alerts.c.category == "HASH",
+    alerts.c.sha256.in_(bindparam("shas", expanding=True)),
+    alerts.c.ts >= bindparam("since"),
+)
+
 CPU_HIGH = float(os.environ.get("CPU_HIGH", "90"))
 RAM_RATIO_HIGH = float(os.environ.get("RAM_RATIO_HIGH", "0.9"))
 
@@ -167,76 +303,355 @@ def _utcnow_naive() -> datetime:
     """naive UTC (for your logs.created_at which is 'timestamp without time zone')"""
     return datetime.utcnow()
 
+_UTC = timezone.utc
+
 def _parse_iso_to_aware(v: Optional[str]) -> Optional[datetime]:
+    """Called once per hash row. Agents send '+00:00' stamps, which come back already in
+    UTC, so the common case is one C-level fromisoformat and no astimezone."""
     if not v: return None
     try:
-        s = str(v)
-        if s.endswith("Z"): s = s[:-1] + "+00:00"
-        dt = datetime.fromisoformat(s)
-        if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
-        return dt.astimezone(timezone.utc)
-    except Exception:
+        dt = datetime.fromisoformat(v)   # accepts a trailing "Z" on 3.11+
+    except ValueError:
+        if not v.endswith("Z"):
+            return None
+        try:
+            dt = datetime.fromisoformat(v[:-1] + "+00:00")
+        except ValueError:
+            return None
+    except TypeError:
         return None
+    tz = dt.tzinfo
+    if tz is _UTC: return dt
+    if tz is None: return dt.replace(tzinfo=_UTC)
+    return dt.astimezone(_UTC)
+
+METRICS_MAX_BYTES = int(os.environ.get("METRICS_MAX_BYTES", str(256 * 1024)))
+HASHES_MAX_BYTES = int(os.environ.get("HASHES_MAX_BYTES", str(5 * 1024 * 1024)))
+
+def _json_body(max_bytes: int):
+    """Dependency that reads the JSON body on the event loop, so the endpoint itself can be
+    a sync `def`. Bodies over `max_bytes` get a 413 before anything is parsed; a body sent
+    with Content-Encoding: gzip is inflated under the same cap."""
+    async def read(request: Request) -> dict:
+        too_large = HTTPException(status_code=413, detail="Payload too large")
+        try:
+            clen = int(request.headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if clen > max_bytes:
+            raise too_large
+        # Content-Length may be absent (chunked) or wrong, so cap the stream as well.
+        buf = bytearray()
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) > max_bytes:
+                raise too_large
+        if request.headers.get("content-encoding", "").lower() == "gzip":
+            try:
+                buf = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(buf, max_bytes + 1)
+            except zlib.error:
+                raise HTTPException(status_code=400, detail="Invalid gzip body")
+            if len(buf) > max_bytes:
+                raise too_large
+        try:
+            data = orjson.loads(buf)
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+        return data
+    return read
+
+# -------------------- JSON snapshots (background writer) --------------------
+# Requests only encode + enqueue; a single thread does the file I/O in batches.
+JSON_QUEUE_SIZE = int(os.environ.get("JSON_QUEUE_SIZE", "1024"))
+JSON_WRITE_BATCH = 256
+_write_q: "queue.Queue[Optional[Tuple[Path, bytes]]]" = queue.Queue(maxsize=JSON_QUEUE_SIZE)
+_writer_thread: Optional[threading.Thread] = None
+
+# Snapshots are written once and never rewritten: O_EXCL refuses to clobber an existing
+# file, O_DSYNC makes the data durable without the extra metadata sync of fsync().
+# (getattr: O_DSYNC/O_CLOEXEC don't exist on Windows, O_BINARY only does.)
+_SNAPSHOT_FLAGS = (os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_DSYNC", 0)
+                   | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0))
+_snapshot_dirs: set = set()   # day directories already created (writer thread only)
+
+def _write_json_file(path: Path, data: bytes) -> None:
+    try:
+        if path.parent not in _snapshot_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _snapshot_dirs.add(path.parent)
+        with os.fdopen(os.open(path, _SNAPSHOT_FLAGS, 0o644), "wb") as f:
+            f.write(data)
+    except OSError as e:
+        log.error("[DISK] write %s failed: %s", path, e)
+
+def _json_writer() -> None:
+    """Drains _write_q until a None sentinel arrives."""
+    while True:
+        item = _write_q.get()
+        batch = [item]
+        while item is not None and len(batch) < JSON_WRITE_BATCH:
+            try:
+                item = _write_q.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+        for entry in batch:
+            if entry is None:
+                return
+            _write_json_file(*entry)
+
+@app.on_event("startup")
+def _start_json_writer() -> None:
+    global _writer_thread
+    _writer_thread = threading.Thread(target=_json_writer, name="json-writer", daemon=True)
+    _writer_thread.start()
+
+@app.on_event("shutdown")
+def _stop_json_writer() -> None:
+    if _writer_thread is not None:
+        _write_q.put(None)   # queued after pending writes, so they still land
+        _writer_thread.join(timeout=10)
 
 def _save_json_to_disk(data: dict) -> Tuple[str, datetime]:
+    """Picks the snapshot path and queues the write; returns before the file exists.
+
+    Layout: logs/YYYY/MM/DD/<host>_<YYYYmmddTHHMMSS_ffffff>_<rand>.json -- microseconds plus
+    a random suffix so two posts from one host in the same second don't collide, and one
+    directory per day so no single directory grows without bound.
+    """
     ts = _utcnow_tz()
-    hn = (str(data.get("hostname") or "unknown")).replace(" ", "_")
-    path = UPLOAD_DIR / f"{hn}_{ts.strftime('%Y-%m-%d_%H-%M-%S')}.json"
+    hn = str(data.get("hostname") or "unknown")
+    for ch in (" ", "/", "\\"):
+        hn = hn.replace(ch, "_")
+    path = (UPLOAD_DIR / ts.strftime("%Y/%m/%d")
+            / f"{hn}_{ts.strftime('%Y%m%dT%H%M%S_%f')}_{secrets.token_hex(2)}.json")
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
+        body = orjson.dumps(data)
+    except orjson.JSONEncodeError as e:
+        log.error("[DISK] encode %s failed: %s", path, e)
+    else:
+        _write_q.put((path, body))
     return str(path), ts
 
-def _insert_alert(*, hostname: str, category: str, description: str,
-                  severity: str = "CRITICAL", label: str = "Critical issue",
-                  file_path: Optional[str] = None, sha256: Optional[str] = None,
-                  cpu: Optional[float] = None, ram_ratio: Optional[float] = None) -> None:
+# -------------------- logs rows (background writer) --------------------
+# /collect-metrics arrives every few seconds from every agent; its logs row is buffered and
+# flushed with one executemany every LOGS_FLUSH_SECS or LOGS_FLUSH_ROWS rows, whichever first.
+LOGS_FLUSH_SECS = float(os.environ.get("LOGS_FLUSH_SECS", "0.5"))
+LOGS_FLUSH_ROWS = 200
+_logs_q: "queue.Queue[Optional[dict]]" = queue.Queue(maxsize=JSON_QUEUE_SIZE)
+_logs_thread: Optional[threading.Thread] = None
+
+def _logs_writer() -> None:
+    """Drains _logs_q in batches until a None sentinel arrives."""
+    while True:
+        batch = [_logs_q.get()]
+        deadline = time.monotonic() + LOGS_FLUSH_SECS
+        while batch[-1] is not None and len(batch) < LOGS_FLUSH_ROWS:
+            try:
+                batch.append(_logs_q.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        rows = [r for r in batch if r is not None]
+        if rows:
+            try:
+                with engine.begin() as conn:
+                    conn.execute(_INS_LOGS, rows)
+            except SQLAlchemyError as e:
+                log.error("[DB] insert %d logs rows failed: %s", len(rows), e)
+        if len(rows) != len(batch):
+            return
+
+@app.on_event("startup")
+def _start_logs_writer() -> None:
+    global _logs_thread
+    _logs_thread = threading.Thread(target=_logs_writer, name="logs-writer", daemon=True)
+    _logs_thread.start()
+
+@app.on_event("shutdown")
+def _stop_logs_writer() -> None:
+    if _logs_thread is not None:
+        _logs_q.put(None)   # queued after pending rows, so they still land
+        _logs_thread.join(timeout=10)
+
+def _alert_row(*, hostname: str, category: str, description: str,
+               severity: str = "CRITICAL", label: str = "Critical issue",
+               file_path: Optional[str] = None, sha256: Optional[str] = None,
+               cpu: Optional[float] = None, ram_ratio: Optional[float] = None,
+               ts: Optional[datetime] = None) -> dict:
+    return {
+        "ts": ts or _utcnow_tz(), "hostname": hostname, "category": category, "severity": severity,
+        "label": label, "description": description[:1024],
+        "file_path": (file_path[:1024] if file_path else None),
+        "sha256": (sha256[:64] if sha256 else None),
+        "cpu": cpu, "ram_ratio": ram_ratio,
+    }
+
+def _insert_alerts(values: List[dict], conn=None) -> None:
+    """Inserts a batch of alert rows (see _alert_row).
+
+    With `conn` the rows join the caller's transaction (and errors propagate);
+    otherwise a transaction of its own is opened and failures are only logged.
+    """
+    if not values:
+        return
+    if conn is not None:
+        conn.execute(_INS_ALERTS, values)
+        return
     try:
         with engine.begin() as conn:
-            conn.execute(insert(alerts).values(
-                ts=_utcnow_tz(), hostname=hostname, category=category, severity=severity,
-                label=label, description=description[:1024],
-                file_path=(file_path[:1024] if file_path else None),
-                sha256=(sha256[:64] if sha256 else None),
-                cpu=cpu, ram_ratio=ram_ratio
-            ))
+            conn.execute(_INS_ALERTS, values)
+    except SQLAlchemyError as e:
+        log.error("[DB] insert alerts failed: %s", e)
+
+_FILE_HASH_COLS = ("ts", "hostname", "file_path", "sha256", "size", "mtime", "error")
+
+_FH_STAGE = "_file_hashes_stage"
+
+def _copy_file_hashes(conn, rows: List[tuple]) -> int:
+    """Bulk-load rows with COPY FROM STDIN (psycopg2) inside the caller's transaction.
+
+    COPY has no ON CONFLICT, so rows land in a per-session temp table first and are moved
+    over with INSERT ... SELECT ... ON CONFLICT DO NOTHING. Returns rows actually inserted.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf, quoting=csv.QUOTE_MINIMAL)
+    for r in rows:
+        # unquoted empty field == NULL in COPY csv
+        w.writerow(["" if v is None else v for v in r])
+    buf.seek(0)
+    cols = ",".join(_FILE_HASH_COLS)
+    cur = conn.connection.cursor()
+    try:
+        cur.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {_FH_STAGE} ON COMMIT DELETE ROWS "
+            f"AS SELECT {cols} FROM {file_hashes.name} WITH NO DATA"
+        )
+        cur.copy_expert(f"COPY {_FH_STAGE} ({cols}) FROM STDIN WITH (FORMAT csv)", buf)
+        cur.execute(
+            f"INSERT INTO {file_hashes.name} ({cols}) SELECT {cols} FROM {_FH_STAGE} "
+            f"ON CONFLICT ({','.join(_FILE_HASH_KEY)}) DO NOTHING"
+        )
+        return cur.rowcount
+    finally:
+        cur.close()
+
+def _insert_file_hashes(conn, rows: List[tuple]) -> int:
+    """Inserts rows (tuples in _FILE_HASH_COLS order), skipping ones already stored;
+    returns how many were new."""
+    if _USE_COPY and len(rows) >= COPY_MIN_ROWS:
+        return _copy_file_hashes(conn, rows)
+    # multi-VALUES statements, so rowcount is exact (executemany's often isn't); chunked to
+    # stay under per-statement bind limits (SQLite: 999)
+    step = 999 // len(_FILE_HASH_COLS)
+    total = 0
+    for i in range(0, len(rows), step):
+        chunk = [dict(zip(_FILE_HASH_COLS, r)) for r in rows[i:i + step]]
+        total += conn.execute(_INS_FILE_HASHES.values(chunk)).rowcount
+    return total
+
+# -------------------- IOC cache --------------------
+# The IOC table changes on the order of minutes while /collect-hashes runs many times a
+# second, so matching is done against an in-memory snapshot refreshed in the background.
+IOC_REFRESH_SECS = int(os.environ.get("IOC_REFRESH_SECS", "30"))
+# Sorted, de-duplicated array of raw 32-byte digests: 32 bytes per IOC and no Python
+# object per entry, so feeds of millions of hashes stay small. Swapped whole on refresh.
+_ioc_digests = np.empty(0, dtype="S32")
+_HEX_LOWER = frozenset("0123456789abcdef")
+_ioc_stop = threading.Event()
+
+def _refresh_ioc() -> None:
+    global _ioc_digests
+    if _SEL_IOC_ALL is None:
+        return
+    try:
+        with engine.connect() as conn:
+            digests = []
+            for (v,) in conn.execute(_SEL_IOC_ALL):
+                v = v.strip()
+                if len(v) == 64 and _HEX_LOWER.issuperset(v):   # skip malformed feed rows
+                    digests.append(bytes.fromhex(v))
+        _ioc_digests = np.unique(np.array(digests, dtype="S32"))
+        log.debug("[IOC] snapshot holds %d digests", len(_ioc_digests))
     except SQLAlchemyError as e:
-        print(f"[DB] insert alert failed: {e}")
+        log.error("[IOC] refresh failed (keeping %d cached): %s", len(_ioc_digests), e)
+
+def _ioc_hits(shas: List[str]) -> List[str]:
+    """The lowercase-hex digests in `shas` that are in the IOC snapshot (binary search)."""
+    ioc = _ioc_digests
+    if not shas or not len(ioc):
+        return []
+    cand = np.array([bytes.fromhex(s) for s in shas], dtype="S32")
+    pos = np.minimum(np.searchsorted(ioc, cand), len(ioc) - 1)
+    return [s for s, hit in zip(shas, (ioc[pos] == cand).tolist()) if hit]
+
+def _ioc_refresher() -> None:
+    while not _ioc_stop.wait(IOC_REFRESH_SECS):
+        _refresh_ioc()
+
+@app.on_event("startup")
+def _start_ioc_refresher() -> None:
+    _refresh_ioc()   # first load is synchronous so matching works from the first request
+    threading.Thread(target=_ioc_refresher, name="ioc-refresh", daemon=True).start()
+
+@app.on_event("shutdown")
+def _stop_ioc_refresher() -> None:
+    _ioc_stop.set()
 
 # -------------------- in-memory metrics cache for /api/metrics --------------------
 METRICS_HISTORY_LEN = 20
 STALE_SECS = int(os.environ.get("METRICS_STALE_SECS", "30"))
-_metrics_cache = {}   # hostname -> {ts, fields...}
+# Structure-of-Arrays: one float64 row per field, one column per host, so /api/metrics
+# reduces whole rows with numpy instead of walking per-host dicts.
+_TS, _CPU, _RAM_TOTAL, _RAM_USED, _DISK_TOTAL, _DISK_USED, _NET_IN, _NET_OUT = range(8)
+_INT_FIELDS = [_RAM_TOTAL, _RAM_USED, _DISK_TOTAL, _DISK_USED, _NET_IN, _NET_OUT]
+_metrics = np.zeros((8, 64), dtype=np.float64)   # grows by doubling columns
+
+@dataclass(slots=True)
+class _Host:
+    col: int   # column in _metrics
+    ip: str
+
+_hosts: Dict[str, _Host] = {}   # insertion order == column order
+# Running totals over all cached hosts, kept in step with _metrics by _store_metrics,
+# so the dashboard averages are one divide instead of a reduction per request.
+_cpu_sum = 0.0
+_ram_pct_sum = 0.0
+_metrics_lock = threading.Lock()
+_metrics_gen = 0   # bumped on every write, so /api/metrics knows when its cached body is stale
 _history_up   = deque(maxlen=METRICS_HISTORY_LEN)
 _history_down = deque(maxlen=METRICS_HISTORY_LEN)
 _history_cpu  = deque(maxlen=METRICS_HISTORY_LEN)
 _history_ram  = deque(maxlen=METRICS_HISTORY_LEN)
 
+def _ram_pct(ram_total: float, ram_used: float) -> float:
+    return (ram_used / ram_total * 100.0) if ram_total > 0 else 0.0
+
+def _store_metrics(hostname: str, ip: str, values: Tuple[float, ...]) -> None:
+    """Writes one host's sample (fields in _TS.._NET_OUT order) into its column."""
+    global _metrics, _cpu_sum, _ram_pct_sum, _metrics_gen
+    with _metrics_lock:
+        host = _hosts.get(hostname)
+        if host is None:
+            host = _hosts[hostname] = _Host(len(_hosts), ip)
+            if host.col == _metrics.shape[1]:
+                _metrics = np.concatenate([_metrics, np.zeros_like(_metrics)], axis=1)
+        host.ip = ip
+        i = host.col
+        old = _metrics[:, i].tolist()   # zeros for a new host
+        _cpu_sum += values[_CPU] - old[_CPU]
+        _ram_pct_sum += (_ram_pct(values[_RAM_TOTAL], values[_RAM_USED])
+                         - _ram_pct(old[_RAM_TOTAL], old[_RAM_USED]))
+        _metrics[:, i] = values
+        _metrics_gen += 1
+
 # -------------------- endpoints --------------------
 @app.post("/collect-metrics")
-async def collect_metrics(request: Request) -> JSONResponse:
-    # Parse JSON
-    try:
-        data = await request.json()  
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
-
-    # Save JSON to disk and insert to YOUR logs table
+def collect_metrics(data: dict = Depends(_json_body(METRICS_MAX_BYTES))) -> ORJSONResponse:
+    # Save JSON to disk
     file_path, ts_aware = _save_json_to_disk(data)
     hostname = str(data.get("hostname") or "unknown")
-    try:
-        with engine.begin() as conn:
-            conn.execute(insert(logs).values(
-                device_id=None,
-                device_name=hostname,
-                log_path=file_path,
-                severity="METRICS",
-                created_at=_utcnow_naive(),   # naive UTC for 'timestamp without time zone'
-            ))
-    except SQLAlchemyError as e:
-        print("[DB] insert logs failed:", e)
 
     # Extract / compute for cache + alerts
     rt = float(data.get("ramTotal") or 0.0)
@@ -251,50 +666,56 @@ async def collect_metrics(request: Request) -> JSONResponse:
         dt = du = 0.0
 
     # Update in-memory cache (for UI)
-    _metrics_cache[hostname] = {
-        "ts": ts_aware,
-        "name": hostname,
-        "ip": str(data.get("ip") or data.get("ip_address") or ""),
-        "status": "up",
-        "cpu": cpu,
-        "ramTotal": int(rt),
-        "ramUsed": int(ru),
-        "diskTotal": int(dt),
-        "diskUsed": int(du),
-        "netIn": int(data.get("netIn") or 0),
-        "netOut": int(data.get("netOut") or 0),
-    }
+    _store_metrics(hostname, str(data.get("ip") or data.get("ip_address") or ""), (
+        ts_aware.timestamp(), cpu, int(rt), int(ru), int(dt), int(du),
+        int(data.get("netIn") or 0), int(data.get("netOut") or 0),
+    ))
 
     # Threshold-based alert
-    if cpu >= CPU_HIGH or ram_ratio >= RAM_RATIO_HIGH:
+    alerted = cpu >= CPU_HIGH or ram_ratio >= RAM_RATIO_HIGH
+    alert = None
+    if alerted:
         reasons = []
-        try:
-            send_critical_email()
-        except Exception as e:
-            print(f"[ALERT] send_critical_email failed: {e}")
         if cpu >= CPU_HIGH: reasons.append(f"CPU {cpu:.1f}% >= {CPU_HIGH:.1f}%")
         if ram_ratio >= RAM_RATIO_HIGH: reasons.append(f"RAM ratio {ram_ratio:.2f} >= {RAM_RATIO_HIGH:.2f}")
         description = "Resource usage threshold exceeded: " + ", ".join(reasons)
-        _insert_alert(
+        alert = _alert_row(
             hostname=hostname, category="RESOURCE",
             description=description, severity="CRITICAL", label="Critical issue",
             cpu=cpu, ram_ratio=ram_ratio
         )
 
-    return JSONResponse({
-        "ok": True, "saved_file": file_path, "resource_alerted": cpu >= CPU_HIGH or ram_ratio >= RAM_RATIO_HIGH
+    # logs row (YOUR logs table) goes out with the next batch; the rare alert is written now
+    _logs_q.put({
+        "device_id": None,
+        "device_name": hostname,
+        "log_path": file_path,
+        "severity": "METRICS",
+        "created_at": _utcnow_naive(),   # naive UTC for 'timestamp without time zone'
+    })
+    if alert:
+        _insert_alerts([alert])
+
+    # SMTP only after the commit, so no transaction is held open during the send
+    if alerted:
+        try:
+            send_critical_email()
+        except Exception as e:
+            log.error("[ALERT] send_critical_email failed: %s", e)
+
+    return ORJSONResponse({
+        "ok": True, "saved_file": file_path, "resource_alerted": alerted
     })
 
 # Backward compatibility
 @app.post("/collect-data")
-async def collect_data_compat(request: Request):
-    return await collect_metrics(request)
+def collect_data_compat(data: dict = Depends(_json_body(METRICS_MAX_BYTES))):
+    return collect_metrics(data)
 
 @app.post("/collect-hashes")
-async def collect_hashes(request: Request) -> JSONResponse:
-    # Parse
+def collect_hashes(payload: dict = Depends(_json_body(HASHES_MAX_BYTES))) -> ORJSONResponse:
+    # Validate
     try:
-        payload = await request.json()
         hostname = (payload.get("hostname") or "").strip()
         hashes = payload.get("hashes") or []
         if not hostname or not isinstance(hashes, list):
@@ -302,149 +723,155 @@ async def collect_hashes(request: Request) -> JSONResponse:
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid JSON structure")
 
-    # Save JSON + insert logs row (severity=HASH)
+    # Save JSON
     json_path, ts_aware = _save_json_to_disk(payload)
-    try:
-        with engine.begin() as conn:
-            conn.execute(insert(logs).values(
-                device_id=None,
-                device_name=hostname,
-                log_path=json_path,
-                severity="HASH",
-                created_at=_utcnow_naive(),
-            ))
-    except SQLAlchemyError as e:
-        print("[DB] insert logs failed:", e)
 
     # Truncate batch
     MAX_ROWS = 20000
     hashes = hashes[:MAX_ROWS]
     ts_now = _utcnow_tz()
 
-    rows = []
-    sha_set = set()
+    # tuples in _FILE_HASH_COLS order, in a list sized for the whole batch up front
+    rows: List[tuple] = [None] * len(hashes)
+    n = 0
+    path_by_sha = defaultdict(list)   # IOC-candidate sha256 -> file paths reporting it
     for h in hashes:
-        fp = str(h.get("file_path") or "")
+        fp = str(h.get("file_path") or "")[:1024]
         if not fp: continue
         sha = h.get("sha256")
+        sha = str(sha).lower() if sha else None   # normalized once; stored lowercase
         size = h.get("size")
-        mtime = _parse_iso_to_aware(h.get("mtime"))
         err = h.get("error")
-        rows.append({
-            "ts": ts_now, "hostname": hostname, "file_path": fp[:1024],
-            "sha256": (str(sha) if sha else None),
-            "size": (int(size) if isinstance(size, (int, float)) else None),
-            "mtime": mtime, "error": (str(err)[:512] if err else None)
-        })
-        if sha and isinstance(sha, str) and len(sha) == 64:
-            sha_set.add(sha.lower())
-
-    # Insert file_hashes
-    try:
-        if rows:
-            with engine.begin() as conn:
-                conn.execute(insert(file_hashes), rows)
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=500, detail=f"DB insert error: {e}")
+        rows[n] = (
+            ts_now, hostname, fp, sha,
+            (int(size) if isinstance(size, (int, float)) else None),
+            _parse_iso_to_aware(h.get("mtime")), (str(err)[:512] if err else None),
+        )
+        n += 1
+        # only well-formed hex digests can match an IOC
+        if sha and len(sha) == 64 and _HEX_LOWER.issuperset(sha):
+            path_by_sha[sha].append(fp)
 
-    # IOC lookup
-    inserted_alerts = 0
-    if sha_set and IOC_TABLE_NAME:
-        try:
-            with engine.connect() as conn:
-                try:
-                    ioc_col = suspicious_hashes.c[IOC_COL_SHA]
-                except KeyError:
-                    raise HTTPException(status_code=500, detail=f"IOC column '{IOC_COL_SHA}' not found on table '{IOC_TABLE_NAME}'")
-                stmt = select(func.lower(ioc_col)).where(
-                    func.lower(ioc_col).in_(bindparam("sha_list", expanding=True))
-                )
-                bad = {row[0] for row in conn.execute(stmt, {"sha_list": list(sha_set)})}
-        except SQLAlchemyError as e:
-            raise HTTPException(status_code=500, detail=f"DB query error: {e}")
-
-        if bad:
-            for h in rows:
-                sha = (h["sha256"] or "").lower() if h["sha256"] else None
-                if sha and sha in bad:
-                    description = f"Malicious hash detected ({sha}) in file: {h['file_path']}"
-                    _insert_alert(
+    del rows[n:]
+
+    # IOC match against the cached snapshot -- no DB round-trip
+    if path_by_sha and _SEL_IOC_ALL is None:
+        raise HTTPException(status_code=500, detail=f"IOC column '{IOC_COL_SHA}' not found on table '{suspicious_hashes.name}'")
+    hits = _ioc_hits(list(path_by_sha))
+    alert_rows = []
+
+    # logs row (severity=HASH) + file_hashes + alerts in one transaction
+    try:
+        with engine.begin() as conn:
+            if hits:
+                # one query for every (sha, path) this host was alerted on recently
+                seen = set()
+                if HASH_ALERT_DEDUP_SECS > 0:
+                    seen = set(conn.execute(_SEL_RECENT_HASH_ALERTS, {
+                        "hostname": hostname, "shas": hits,
+                        "since": ts_now - timedelta(seconds=HASH_ALERT_DEDUP_SECS),
+                    }).tuples())
+                alert_rows = [
+                    _alert_row(
                         hostname=hostname, category="HASH",
-                        description=description, severity="CRITICAL", label="Critical issue",
-                        file_path=h["file_path"], sha256=sha
+                        description=f"Malicious hash detected ({sha}) in file: {fp}",
+                        severity="CRITICAL", label="Critical issue",
+                        file_path=fp, sha256=sha, ts=ts_now
                     )
-                    inserted_alerts += 1
+                    for sha in hits
+                    for fp in path_by_sha[sha]
+                    if (sha, fp) not in seen
+                ]
+            conn.execute(_INS_LOGS, {
+                "device_id": None,
+                "device_name": hostname,
+                "log_path": json_path,
+                "severity": "HASH",
+                "created_at": _utcnow_naive(),
+            })
+            inserted = _insert_file_hashes(conn, rows) if rows else 0
+            _insert_alerts(alert_rows, conn=conn)
+    except (SQLAlchemyError, _DBAPI_ERROR) as e:
+        raise HTTPException(status_code=500, detail=f"DB error: {e}")
+
+    return ORJSONResponse({"ok": True, "inserted_hash_rows": inserted, "alerts_created": len(alert_rows), "json_saved": json_path})
 
-    return JSONResponse({"ok": True, "inserted_hash_rows": len(rows), "alerts_created": inserted_alerts, "json_saved": json_path})
+# Row lists are built straight from the (server-side) cursor and handed to orjson as-is,
+# skipping the RowMapping copy and FastAPI's jsonable_encoder pass.
+_LIST_STREAM_OPTS = {"stream_results": True, "yield_per": 200}
+# plain str keys: orjson rejects SQLAlchemy's quoted_name (a str subclass) as a dict key
+_ALERT_COLS = tuple(str(c.key) for c in _SEL_ALERTS.selected_columns)
+_LOG_COLS = tuple(str(c.key) for c in _SEL_LOGS.selected_columns)
 
 @app.get("/api/alerts")
-def get_alerts(limit: int = Query(1000, ge=1, le=500)) -> List[dict]:
+def get_alerts(limit: int = Query(1000, ge=1, le=500)) -> ORJSONResponse:
     try:
         with engine.connect() as conn:
-            rows = conn.execute(
-                select(
-                    alerts.c.id, alerts.c.ts, alerts.c.hostname, alerts.c.category,
-                    alerts.c.severity, alerts.c.label, alerts.c.description,
-                    alerts.c.file_path, alerts.c.sha256, alerts.c.cpu, alerts.c.ram_ratio
-                ).order_by(desc(alerts.c.id)).limit(limit)
-            ).mappings().all()
-            return [dict(r) for r in rows]
+            result = conn.execution_options(**_LIST_STREAM_OPTS).execute(_SEL_ALERTS, {"lim": limit})
+            return ORJSONResponse([dict(zip(_ALERT_COLS, r)) for r in result])
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"DB error: {e}")
 
 @app.get("/api/logs")
-def get_logs(limit: int = Query(1000, ge=1, le=500)) -> List[dict]:
+def get_logs(limit: int = Query(1000, ge=1, le=500)) -> ORJSONResponse:
     """Returns rows from your 'logs' table (id, device_id, device_name, log_path, severity, created_at)."""
     try:
         with engine.connect() as conn:
-            rows = conn.execute(
-                select(
-                    logs.c.id, logs.c.device_id, logs.c.device_name,
-                    logs.c.log_path, logs.c.severity, logs.c.created_at
-                ).order_by(desc(logs.c.id)).limit(limit)
-            ).mappings().all()
-            return [dict(r) for r in rows]
+            result = conn.execution_options(**_LIST_STREAM_OPTS).execute(_SEL_LOGS, {"lim": limit})
+            return ORJSONResponse([dict(zip(_LOG_COLS, r)) for r in result])
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=f"DB error: {e}")
 
-# UI contract: live metrics payload
+# UI contract: live metrics payload. The encoded body is reused for up to
+# METRICS_CACHE_SECS while no host reports, so polling dashboards share one rebuild
+# (and history gains at most one point per rebuild).
+METRICS_CACHE_SECS = float(os.environ.get("METRICS_CACHE_SECS", "1"))
+_api_metrics_lock = threading.Lock()
+_api_metrics_body = b""
+_api_metrics_gen = -1
+_api_metrics_at = 0.0
+
 @app.get("/api/metrics")
-def api_metrics() -> dict:
-    now = datetime.now(timezone.utc)
-    servers = []
-    up_count = down_count = 0
-    cpu_vals = []
-    ram_pct_vals = []
-
-    for host, m in list(_metrics_cache.items()):
-        age = (now - m["ts"]).total_seconds() if isinstance(m["ts"], datetime) else STALE_SECS + 1
-        status = "up" if age <= STALE_SECS else "down"
-        if status == "up": up_count += 1
-        else: down_count += 1
-
-        cpu_vals.append(float(m.get("cpu") or 0.0))
-        rt = float(m.get("ramTotal") or 0.0)
-        ru = float(m.get("ramUsed") or 0.0)
-        ram_pct_vals.append((ru / rt * 100.0) if rt > 0 else 0.0)
-
-        servers.append({
-            "name": m.get("name") or host,
-            "ip": m.get("ip") or "",
-            "status": status,
-            "cpu": float(m.get("cpu") or 0.0),
-            "ramTotal": int(m.get("ramTotal") or 0),
-            "ramUsed": int(m.get("ramUsed") or 0),
-            "diskTotal": int(m.get("diskTotal") or 0),
-            "diskUsed": int(m.get("diskUsed") or 0),
-            "netIn": int(m.get("netIn") or 0),
-            "netOut": int(m.get("netOut") or 0),
-        })
-
-    avg_cpu = sum(cpu_vals) / len(cpu_vals) if cpu_vals else 0.0
-    avg_ram = sum(ram_pct_vals) / len(ram_pct_vals) if ram_pct_vals else 0.0
-    _history_up.append(up_count)
-    _history_down.append(down_count)
-    _history_cpu.append(round(avg_cpu, 2))
-    _history_ram.append(round(avg_ram, 2))
-
-    return {"servers": servers, "history": {"up": list(_history_up), "down": list(_history_down), "cpu": list(_history_cpu), "ram": list(_history_ram)}}
+def api_metrics() -> Response:
+    global _api_metrics_body, _api_metrics_gen, _api_metrics_at
+    with _api_metrics_lock:
+        mono = time.monotonic()
+        if _api_metrics_gen == _metrics_gen and mono - _api_metrics_at < METRICS_CACHE_SECS:
+            return Response(_api_metrics_body, media_type="application/json")
+
+        now = time.time()
+        with _metrics_lock:
+            gen = _metrics_gen
+            n = len(_hosts)
+            m = _metrics[:, :n].copy()
+            names = list(_hosts)
+            ips = [h.ip for h in _hosts.values()]
+            avg_cpu = _cpu_sum / n if n else 0.0
+            avg_ram = _ram_pct_sum / n if n else 0.0
+
+        up = (now - m[_TS]) <= STALE_SECS
+        up_count = int(up.sum())
+        down_count = n - up_count
+
+        ints = m[_INT_FIELDS].astype(np.int64).T.tolist()
+        servers = [
+            {
+                "name": name, "ip": ip, "status": "up" if is_up else "down", "cpu": cpu,
+                "ramTotal": r_t, "ramUsed": r_u, "diskTotal": d_t, "diskUsed": d_u,
+                "netIn": n_in, "netOut": n_out,
+            }
+            for name, ip, is_up, cpu, (r_t, r_u, d_t, d_u, n_in, n_out)
+            in zip(names, ips, up.tolist(), m[_CPU].tolist(), ints)
+        ]
+
+        _history_up.append(up_count)
+        _history_down.append(down_count)
+        _history_cpu.append(round(avg_cpu, 2))
+        _history_ram.append(round(avg_ram, 2))
+
+        _api_metrics_body = orjson.dumps({"servers": servers, "history": {
+            "up": list(_history_up), "down": list(_history_down),
+            "cpu": list(_history_cpu), "ram": list(_history_ram),
+        }})
+        _api_metrics_gen, _api_metrics_at = gen, mono
+        return Response(_api_metrics_body, media_type="application/json")
@@ -5,35 +5,49 @@ import socket
 import uuid
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import hashlib
+import gzip
 import time
 import json
+from collections import OrderedDict, deque
 from datetime import datetime, timezone
-from typing import List, Optional, Iterable, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Deque, Dict, Iterator, List, Optional, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
 import threading
 
+# orjson is optional: same JSON several times faster, straight to bytes
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 # ---------- helpers ----------
 def iso_now() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
+# host identity doesn't change while the agent runs, so it's read once at import
+_MAC = uuid.getnode().to_bytes(6, "big").hex(":")
+_HOSTNAME = socket.gethostname()
+_PLATFORM = platform.platform()
+
 def get_mac() -> str:
-    mac = uuid.getnode()
-    return ":".join(["{:02x}".format((mac >> ele) & 0xff) for ele in range(40, -1, -8)])
+    return _MAC
 
 # ---------- metrics ----------
-def collect_metrics() -> dict:
-    """אוסף מדדים מהמערכת המקומית"""
-    cpu_percent = psutil.cpu_percent(interval=0.5)
-    vmem = psutil.virtual_memory()
-    disk = psutil.disk_usage("/")
+def _list_processes() -> List[dict]:
     procs = []
     for p in psutil.process_iter(attrs=["pid", "name"]):
         try:
             procs.append(p.info)
         except Exception:
             pass
+    return procs
+
+def _list_connections() -> List[dict]:
     conns = []
     try:
         for c in psutil.net_connections(kind="inet"):
@@ -48,11 +62,33 @@ def collect_metrics() -> dict:
                 pass
     except Exception:
         pass
+    return conns
+
+# cpu_percent() sleeps for its sampling interval; the process and socket sweeps run meanwhile
+_metrics_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="metrics")
+# The process/socket sweeps (net_connections walks every /proc/<pid>/fd) are the expensive
+# part of a cycle and change slowly, so their last result is reused for inventory_ttl seconds.
+_inventory = (float("-inf"), [], [])  # (time.monotonic() when taken, procs, conns)
+
+def collect_metrics(inventory_ttl: float = 30) -> dict:
+    """אוסף מדדים מהמערכת המקומית"""
+    global _inventory
+    taken, procs, conns = _inventory
+    fresh = time.monotonic() - taken >= inventory_ttl
+    if fresh:
+        procs_f = _metrics_pool.submit(_list_processes)
+        conns_f = _metrics_pool.submit(_list_connections)
+    cpu_percent = psutil.cpu_percent(interval=0.5)
+    vmem = psutil.virtual_memory()
+    disk = psutil.disk_usage("/")
+    if fresh:
+        procs, conns = procs_f.result(), conns_f.result()
+        _inventory = (time.monotonic(), procs, conns)
 
     return {
         "time_local": iso_now(),
-        "hostname": socket.gethostname(),
-        "platform": platform.platform(),
+        "hostname": _HOSTNAME,
+        "platform": _PLATFORM,
         "mac_address": get_mac(),
         "cpu": float(cpu_percent),
         "ramTotal": int(vmem.total),
@@ -63,88 +99,242 @@ def collect_metrics() -> dict:
         "connections": conns[:500],
     }
 
+# one keep-alive connection pool shared by the metrics and hash loops; connection-level
+# failures (server restarting, dropped keep-alive) are retried with backoff. Retry's
+# default allowed_methods leaves POST out of read/status retries, so a request the
+# server may already have processed is not sent twice.
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    # Last resort for a stray lone surrogate (hash records are cleaned by _utf8_text already):
+    # \udcXX escapes would be rejected by the server's parser, so encode it as "?" instead.
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8", "replace")
+
+def _post_json(url: str, payload: dict, timeout: int) -> None:
+    """POST כ-JSON דחוס ב-gzip (רשימות האשים מתכווצות פי כמה)"""
+    body = gzip.compress(_dumps(payload), compresslevel=6)
+    r = _session.post(url, data=body, timeout=timeout, headers={
+        "Content-Type": "application/json", "Content-Encoding": "gzip",
+    })
+    r.raise_for_status()
+
 def send_metrics(server_url: str, payload: dict, timeout: int = 20) -> None:
     """שולח את המדדים לשרת"""
     url = server_url.rstrip("/") + "/collect-metrics"
-    r = requests.post(url, json=payload, timeout=timeout)
-    r.raise_for_status()
+    _post_json(url, payload, timeout)
 
 # ---------- hashing ----------
-def _iter_files(paths: Iterable[str], follow_symlinks: bool = False) -> Iterable[str]:
-    """איטרציה בטוחה על קבצים בתיקיות נתונות"""
+def _iter_files(paths: Iterable[str], follow_symlinks: bool = False) -> Iterable[os.DirEntry]:
+    """איטרציה בטוחה על קבצים בתיקיות נתונות.
+
+    os.scandir ולא os.walk: ה-DirEntry כבר יודע אם זו תיקייה, ובחלונות גם מחזיק את ה-stat.
+    """
     for base in paths:
         base = os.path.expanduser(base)
         if not os.path.isdir(base):
             continue
-        for root, _, files in os.walk(base, followlinks=follow_symlinks):
-            for name in files:
-                yield os.path.join(root, name)
+        stack = [base]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                if follow_symlinks or not entry.is_symlink():
+                                    stack.append(entry.path)
+                            elif entry.is_file():  # FIFOs/devices would block a reader forever
+                                yield entry
+                        except OSError:
+                            continue
+            except OSError:
+                continue  # unreadable directory, same as os.walk without onerror
 
-def _hash_file(fp: str, max_size_bytes: Optional[int]) -> Tuple[str, Optional[str], Optional[int], Optional[str]]:
-    """מחשב SHA-256 לקובץ יחיד"""
+class HashCache:
+    """LRU של path -> (size, mtime_ns, ctime_ns, dev, inode, sha256), נשמר לקובץ JSON בין ריצות.
+
+    קובץ שהמפתח שלו לא השתנה לא נקרא שוב מהדיסק. mtime לבד לא מספיק: cp -p, touch -r
+    ו-tar x כותבים תוכן חדש לאותו inode ומשחזרים את ה-mtime. את ה-ctime אי אפשר לשחזר
+    מ-user space, והוא מתעדכן בכל כתיבה.
+    """
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("[HASH CACHE] ignoring unreadable cache:", e)
+
+    @staticmethod
+    def key(st: os.stat_result) -> list:
+        # scandir's stat on Windows has no dev/inode (always 0), and st_ctime there is the
+        # creation time, so Windows keeps the size + mtime key
+        if os.name == "nt":
+            return [st.st_size, st.st_mtime_ns, 0, 0]
+        return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_dev, st.st_ino]
+
+    def get(self, fp: str, st: os.stat_result) -> Optional[str]:
+        with self._lock:
+            hit = self._entries.get(fp)
+            if hit is None or hit[:-1] != self.key(st):  # also rejects entries with an older key layout
+                return None
+            self._entries.move_to_end(fp)
+            return hit[-1]
+
+    def put(self, fp: str, st: os.stat_result, sha: str) -> None:
+        with self._lock:
+            self._entries[fp] = self.key(st) + [sha]
+            self._entries.move_to_end(fp)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """כתיבה אטומית: קובץ זמני ואז os.replace"""
+        with self._lock:
+            data = list(self._entries.items())
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print("[HASH CACHE] save failed:", e)
+
+# O_NOATIME: hashing shouldn't dirty every inode with an atime update (Linux; the kernel
+# only allows it for the file's owner or root, hence the fallback in _open_for_hash)
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0) | getattr(os, "O_BINARY", 0)
+_NOATIME = getattr(os, "O_NOATIME", 0)
+
+def _open_for_hash(fp: str) -> int:
+    if _NOATIME:
+        try:
+            return os.open(fp, _OPEN_FLAGS | _NOATIME)
+        except PermissionError:
+            pass
+    return os.open(fp, _OPEN_FLAGS)
+
+def _fadvise(fd: int, advice_name: str) -> None:
+    advice = getattr(os, advice_name, None)
+    if advice is not None:
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+def _hash_file(entry: os.DirEntry, max_size_bytes: Optional[int], cache: Optional[HashCache] = None) -> dict:
+    """מחשב SHA-256 לקובץ יחיד ומחזיר רשומה מוכנה לשליחה"""
+    fp = entry.path
+    size = mtime = None
     try:
-        st = os.stat(fp)
+        st = entry.stat()  # cached by scandir on Windows; one stat() call elsewhere
         size = int(st.st_size)
+        mtime = _ts_to_iso_utc(st.st_mtime)  # same stat, no second lookup later
         if max_size_bytes is not None and size > max_size_bytes:
-            return (fp, None, size, "size_exceeds_limit")
-        h = hashlib.sha256()
-        with open(fp, "rb", buffering=1024 * 1024) as f:
-            for chunk in iter(lambda: f.read(1024 * 1024), b""):
-                h.update(chunk)
-        sha = h.hexdigest()
-        print(f"Computed SHA256 for {fp}: {sha}")  # הוספתי לוגינג כאן
-        return (fp, sha, size, None)
+            return _hash_record(fp, None, size, mtime, "size_exceeds_limit")
+        sha = cache.get(fp, st) if cache else None
+        if sha:
+            return _hash_record(fp, sha, size, mtime, None)
+        # unbuffered: file_digest() reads straight into its own buffer, without the GIL
+        with open(_open_for_hash(fp), "rb", buffering=0) as f:
+            st = os.fstat(f.fileno())  # what was actually opened, not the scandir-time view
+            size = int(st.st_size)
+            mtime = _ts_to_iso_utc(st.st_mtime)
+            _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+            if hasattr(hashlib, "file_digest"):  # Python 3.11+
+                sha = hashlib.file_digest(f, "sha256").hexdigest()
+            else:
+                h = hashlib.sha256()
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(chunk)
+                sha = h.hexdigest()
+            # read once: drop the pages so a scan does not evict the host's own cache
+            _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+        print(f"Computed SHA256 for {_utf8_text(fp)}: {sha}")  # הוספתי לוגינג כאן
+        if cache:
+            cache.put(fp, st, sha)
+        return _hash_record(fp, sha, size, mtime, None)
     except Exception as e:
-        try:
-            size = int(os.path.getsize(fp))
-        except Exception:
-            size = None
-        return (fp, None, size, str(e)[:200])
+        return _hash_record(fp, None, size, mtime, str(e)[:200])
+
+def _utf8_text(s: str) -> str:
+    """שם קובץ שאינו UTF-8 תקין (surrogates) -> טקסט תקין עם \\xNN במקום הבייטים הבעייתיים"""
+    try:
+        s.encode("utf-8")
+        return s
+    except UnicodeEncodeError:
+        pass
+    try:
+        raw = s.encode("utf-8", "surrogateescape")  # POSIX: the original undecodable bytes
+    except UnicodeEncodeError:
+        raw = s.encode("utf-8", "surrogatepass")  # Windows: unpaired UTF-16 surrogates
+    return raw.decode("utf-8", "backslashreplace")
+
+def _hash_record(fp: str, sha: Optional[str], size: Optional[int], mtime: Optional[str], err: Optional[str]) -> dict:
+    return {"file_path": _utf8_text(fp), "sha256": sha, "size": size, "mtime": mtime,
+            "error": _utf8_text(err) if err else err}
 
 def _ts_to_iso_utc(ts: float) -> str:
     return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
 
+def default_workers() -> int:
+    """הגיבוב חוסם על I/O ומשחרר את ה-GIL, לכן יותר threads מליבות"""
+    return min(32, (os.cpu_count() or 1) * 4)
+
+def iter_file_hashes(
+    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int,
+    cache: Optional[HashCache] = None
+) -> Iterator[dict]:
+    """סורק את התיקיות ומניב רשומות האש אחת-אחת, בלי להחזיק את כל הסריקה בזיכרון"""
+    max_size_bytes = None if max_size_mb is None or max_size_mb < 0 else max_size_mb * 1024 * 1024
+    files = _iter_files(dirs, follow_symlinks=follow_symlinks)
+    if max_files:
+        files = islice(files, max_files)
+    workers = max(1, workers)
+    # Executor.map would submit the whole walk up front; a bounded window keeps a few futures per worker
+    window = workers * 4
+    pending: Deque[Future] = deque()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for entry in files:
+            pending.append(ex.submit(_hash_file, entry, max_size_bytes, cache))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    if cache:
+        cache.save()
+
 def collect_file_hashes(
-    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int
+    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int,
+    cache: Optional[HashCache] = None
 ) -> List[dict]:
     """סורק את התיקיות, מחשב האשים ומחזיר רשימת רשומות"""
-    max_size_bytes = None if max_size_mb is None or max_size_mb < 0 else max_size_mb * 1024 * 1024
-    files = []
-    for i, fp in enumerate(_iter_files(dirs, follow_symlinks=follow_symlinks), start=1):
-        files.append(fp)
-        if max_files and i >= max_files:
-            break
-
-    results: List[dict] = []
-    if not files:
-        return results
-
-    with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
-        futures = {ex.submit(_hash_file, fp, max_size_bytes): fp for fp in files}
-        for fut in as_completed(futures):
-            fp, sha, size, err = fut.result()
-            try:
-                mtime = _ts_to_iso_utc(os.path.getmtime(fp))
-            except Exception:
-                mtime = None
-            results.append({
-                "file_path": fp,
-                "sha256": sha,
-                "size": size,
-                "mtime": mtime,
-                "error": err
-            })
-    return results
-
-def send_hashes(server_url: str, hostname: str, hashes: List[dict], timeout: int = 60, chunk_size: int = 2000) -> None:
-    """שולח האשים לשרת במנות"""
+    return list(iter_file_hashes(dirs, max_size_mb, max_files, follow_symlinks, workers, cache))
+
+def send_hashes(server_url: str, hostname: str, hashes: Iterable[dict], timeout: int = 60, chunk_size: int = 2000) -> int:
+    """שולח האשים לשרת במנות; מקבל גם גנרטור ומחזיר כמה נשלחו"""
     url = server_url.rstrip("/") + "/collect-hashes"
-    for i in range(0, len(hashes), chunk_size):
-        batch = hashes[i:i + chunk_size]
-        if batch:  # הוספתי תנאי כדי לוודא שליחה רק אם יש תוכן
-            print(f"Sending batch of {len(batch)} hashes to {url}")  # לוגינג חדש
-            r = requests.post(url, json={"hostname": hostname, "hashes": batch}, timeout=timeout)
-            r.raise_for_status()
+    sent = 0
+    it = iter(hashes)
+    while True:
+        batch = list(islice(it, chunk_size))
+        if not batch:  # הוספתי תנאי כדי לוודא שליחה רק אם יש תוכן
+            return sent
+        print(f"Sending batch of {len(batch)} hashes to {url}")  # לוגינג חדש
+        _post_json(url, {"hostname": hostname, "hashes": batch}, timeout)
+        sent += len(batch)
 
 # ---------- new: hash once ----------
 def generate_hashes_once(
@@ -152,7 +342,8 @@ def generate_hashes_once(
     max_size_mb: int,
     max_files: int,
     workers: int,
-    output_file: str = "hashes.json"
+    output_file: str = "hashes.json",
+    cache: Optional[HashCache] = None
 ) -> None:
     """סריקת האשים חד־פעמית ושמירה ל־JSON מקומי"""
     print(f"[HASH ONCE] scanning {len(dirs)} dir(s): {dirs}")
@@ -161,7 +352,8 @@ def generate_hashes_once(
         max_size_mb=max_size_mb,
         max_files=max_files,
         follow_symlinks=False,
-        workers=workers
+        workers=workers,
+        cache=cache
     )
     print(f"[HASH ONCE] collected {len(hashes)} entries; saving to {output_file}...")
     try:
@@ -177,44 +369,51 @@ def hash_once_loop(
     max_files: int,
     workers: int,
     output_file: str,
-    interval_hours: int = 5
+    interval_hours: int = 5,
+    cache: Optional[HashCache] = None
 ):
     """מריץ hash פעם אחת ושומר ל-JSON, מחכה X שעות, וחוזר"""
     while True:
-        generate_hashes_once(dirs, max_size_mb, max_files, workers, output_file)
+        generate_hashes_once(dirs, max_size_mb, max_files, workers, output_file, cache)
         print(f"[HASH ONCE LOOP] sleeping {interval_hours}h...")
         time.sleep(interval_hours * 3600)
 
 # ---------- loops ----------
-def metrics_loop(server: str, interval: int):
+def metrics_loop(server: str, interval: int, inventory_ttl: float = 30):
     """לולאת שליחה מחזורית של מדדים"""
     while True:
         try:
-            payload = collect_metrics()
+            payload = collect_metrics(inventory_ttl)
             send_metrics(server, payload)
         except Exception as e:
             print("[METRICS ERROR]", e)
         time.sleep(max(1, int(interval)))
 
-def hash_loop(server: str, dirs: List[str], interval: int, max_size_mb: int, max_files: int, workers: int):
-    """לולאת סריקה מחזורית של קבצים ושליחת האשים"""
-    hostname = socket.gethostname()
+def hash_loop(server: str, dirs: List[str], interval: int, max_size_mb: int, max_files: int, workers: int,
+              cache: Optional[HashCache] = None, full_every: int = 24):
+    """לולאת סריקה מחזורית של קבצים ושליחת האשים (רק שינויים, ושליחה מלאה כל full_every סבבים)"""
+    hostname = _HOSTNAME
+    # path -> sha256 of the last batch the server accepted
+    last_sent: Dict[str, Optional[str]] = {}
+    cycle = 0
     while True:
         try:
             print(f"[HASH] scanning {len(dirs)} dir(s): {dirs}")
-            hashes = collect_file_hashes(
-                dirs=dirs,
-                max_size_mb=max_size_mb,
-                max_files=max_files,
-                follow_symlinks=False,
-                workers=workers
-            )
-            print(f"[HASH] collected {len(hashes)} entries; sending...")
-            if hashes:
-                send_hashes(server, hostname, hashes)
-                print("[HASH OK] sent batch")
-            else:
-                print("[HASH OK] []")
+            # IOCs are matched on upload, so a periodic full batch re-checks unchanged files against new IOCs
+            full = full_every <= 1 or cycle % full_every == 0
+            current: Dict[str, Optional[str]] = {}
+
+            def _to_send() -> Iterator[dict]:
+                for h in iter_file_hashes(dirs=dirs, max_size_mb=max_size_mb, max_files=max_files,
+                                          follow_symlinks=False, workers=workers, cache=cache):
+                    current[h["file_path"]] = h["sha256"]
+                    if full or last_sent.get(h["file_path"], "") != h["sha256"]:
+                        yield h
+
+            sent = send_hashes(server, hostname, _to_send())
+            print(f"[HASH OK] scanned {len(current)} entries; sent {sent} ({'full' if full else 'delta'})")
+            last_sent = current
+            cycle += 1
         except Exception as e:
             print("[HASH ERROR]", e)
         time.sleep(max(60, int(interval)))
@@ -224,14 +423,20 @@ def main():
     p = argparse.ArgumentParser()
     p.add_argument("--server", required=True)
     p.add_argument("--metrics-interval", type=int, default=5)
+    p.add_argument("--inventory-interval", type=float, default=30,
+                   help="Seconds between process/connection sweeps; 0 = every metrics cycle")
     p.add_argument("--hash", dest="hash_enable", action="store_true")
     p.add_argument("--hash-dirs", nargs="*", help="Dirs to scan; default: /host if mounted")
     p.add_argument("--hash-interval", type=int, default=3600)
+    p.add_argument("--hash-full-every", type=int, default=24,
+                   help="Send the full hash list every N scans, only changes in between; 1 = always full")
     p.add_argument("--max-size-mb", type=int, default=100)
     p.add_argument("--max-files", type=int, default=5000)
-    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--workers", type=int, default=default_workers(), help="Hashing threads; default: min(32, 4 x CPUs)")
     p.add_argument("--hash-once", action="store_true", help="Run hash scan every 5h and save to JSON")
     p.add_argument("--hash-output", type=str, default="hashes.json", help="Path to save hash JSON file")
+    p.add_argument("--hash-cache", type=str, default="~/.server_monitoring_hash_cache.json",
+                   help="Reuse hashes of files whose size+mtime are unchanged; empty string disables")
     args = p.parse_args()
 
     if args.hash_dirs:
@@ -249,21 +454,24 @@ def main():
     print(f"[agent] metrics interval: {args.metrics_interval}s")
     print(f"[agent] hashing {'enabled' if args.hash_enable else 'disabled'}; dirs: {dirs}")
 
-    t1 = threading.Thread(target=metrics_loop, args=(args.server, args.metrics_interval), daemon=True)
+    cache = HashCache(args.hash_cache) if args.hash_enable and args.hash_cache else None
+
+    t1 = threading.Thread(target=metrics_loop, args=(args.server, args.metrics_interval, args.inventory_interval), daemon=True)
     t1.start()
 
     if args.hash_enable:
         if args.hash_once:
             t2 = threading.Thread(
                 target=hash_once_loop,
-                args=(dirs, args.max_size_mb, args.max_files, args.workers, args.hash_output, 5),
+                args=(dirs, args.max_size_mb, args.max_files, args.workers, args.hash_output, 5, cache),
                 daemon=True
             )
             t2.start()
         else:
             t2 = threading.Thread(
                 target=hash_loop,
-                args=(args.server, dirs, args.hash_interval, args.max_size_mb, args.max_files, args.workers),
+                args=(args.server, dirs, args.hash_interval, args.max_size_mb, args.max_files, args.workers, cache,
+                      args.hash_full_every),
                 daemon=True
             )
             t2.start()
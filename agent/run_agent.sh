@@ -8,7 +8,7 @@ HASH_DIRS="${HASH_DIRS:-/host}"
 HASH_INTERVAL="${HASH_INTERVAL:-3600}"
 AGENT_MAX_SIZE_MB="${AGENT_MAX_SIZE_MB:-100}"
 AGENT_MAX_FILES="${AGENT_MAX_FILES:-5000}"
-AGENT_WORKERS="${AGENT_WORKERS:-4}"
+AGENT_WORKERS="${AGENT_WORKERS:-}"  # empty = agent default, min(32, 4 x CPUs)
 
 # Basic environment variables check
 if [ -z "$SERVER_URL" ]; then
@@ -32,7 +32,7 @@ if [ "$HASH_ENABLE" = "true" ]; then
     --hash-interval "$HASH_INTERVAL" \
     --max-size-mb "$AGENT_MAX_SIZE_MB" \
     --max-files "$AGENT_MAX_FILES" \
-    --workers "$AGENT_WORKERS"
+    ${AGENT_WORKERS:+--workers "$AGENT_WORKERS"}
 else
   exec python -u agent_updated.py \
     --server "$SERVER_URL" \
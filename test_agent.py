@@ -3,17 +3,24 @@ from __future__ import annotations
 # Notes in Hebrew only; all identifiers/strings are English
 
 import argparse
+import gzip
+import json
 import os
 import sys
+import threading
 import time
 import platform
 import socket
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import List, Optional, Iterable, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Optional, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import islice
 import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import shutil
 
 # Try to import psutil for real metrics; fall back gracefully if missing
@@ -25,18 +32,44 @@ except Exception:
     print("[WARN] psutil is not installed. Metrics will be partial. You can install it with:")
     print("       pip install psutil")
 
+# orjson is optional: faster JSON straight to bytes; stdlib json otherwise
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 def iso_now() -> str:
     return datetime.now().isoformat(timespec="seconds")
 
+# host identity doesn't change while the tester runs, so it's read once at import
+_MAC = uuid.getnode().to_bytes(6, "big").hex(":")
+_HOSTNAME = socket.gethostname()
+_PLATFORM = platform.platform()
+
 def get_mac() -> str:
-    mac = uuid.getnode()
-    return ":".join(["{:02x}".format((mac >> ele) & 0xff) for ele in range(40, -1, -8)])
+    return _MAC
 
 # -------- Metrics collection --------
+# cpu_percent(interval=None) reports usage since the previous call, so the metrics interval itself
+# is the sampling window; only a call sooner than _CPU_MIN_WINDOW after the last one waits.
+_CPU_MIN_WINDOW = 0.5
+_cpu_last_sample = time.monotonic()
+if _HAS_PSUTIL:
+    psutil.cpu_percent(interval=None)  # prime the baseline
+
+def _cpu_percent() -> float:
+    global _cpu_last_sample
+    wait = _CPU_MIN_WINDOW - (time.monotonic() - _cpu_last_sample)
+    if wait > 0:
+        time.sleep(wait)  # e.g. --once right after start: keep a meaningful window
+    value = psutil.cpu_percent(interval=None)
+    _cpu_last_sample = time.monotonic()
+    return value
+
 def collect_metrics() -> dict:
     """Collects basic system metrics. Requires psutil for full data."""
     if _HAS_PSUTIL:
-        cpu_percent = psutil.cpu_percent(interval=0.5)
+        cpu_percent = _cpu_percent()
         vmem = psutil.virtual_memory()
         try:
             disk = psutil.disk_usage("/")
@@ -46,15 +79,16 @@ def collect_metrics() -> dict:
             # Fallback to shutil
             t, u, _ = shutil.disk_usage(os.path.abspath(os.sep))
             disk_total, disk_used = int(t), int(u)
+        # only 300 processes / 500 sockets are sent, so stop reading there instead of slicing afterwards
         processes = []
-        for p in psutil.process_iter(attrs=["pid", "name"]):
+        for p in islice(psutil.process_iter(attrs=["pid", "name"]), 300):
             try:
                 processes.append(p.info)
             except Exception:
                 pass
         connections = []
         try:
-            for c in psutil.net_connections(kind="inet"):
+            for c in islice(psutil.net_connections(kind="inet"), 500):
                 try:
                     connections.append({
                         "laddr": f"{c.laddr.ip}:{c.laddr.port}" if c.laddr else None,
@@ -81,20 +115,45 @@ def collect_metrics() -> dict:
 
     return {
         "time_local": iso_now(),
-        "hostname": socket.gethostname(),
-        "platform": platform.platform(),
+        "hostname": _HOSTNAME,
+        "platform": _PLATFORM,
         "mac_address": get_mac(),
         "cpu": float(cpu_percent),
         "ramTotal": ram_total,
         "ramUsed": ram_used,
         "diskTotal": disk_total,
         "diskUsed": disk_used,
-        "processes": processes[:300],
-        "connections": connections[:500],
+        "processes": processes,
+        "connections": connections,
     }
 
+# One keep-alive session for every POST: metrics from the main loop, hashes from the scan
+# thread, so one pooled connection each.
+# Failed connects (server restarting) are retried with backoff. POST itself is not retried, same
+# as the agent: a /collect-metrics repeat after a read timeout or 5xx would write a second logs
+# row and snapshot and could send a duplicate RESOURCE alert email.
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2,
+                       max_retries=Retry(total=3, backoff_factor=0.5))
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    # Last resort for a stray lone surrogate (hash records are cleaned by _utf8_text already):
+    # \udcXX escapes would be rejected by the server's parser, so encode it as "?" instead.
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8", "replace")
+
 def _post_json(url: str, payload: dict, timeout: int) -> None:
-    r = requests.post(url, json=payload, timeout=timeout)
+    # compact + gzip: the server inflates Content-Encoding: gzip bodies
+    body = gzip.compress(_dumps(payload), compresslevel=6)
+    r = _session.post(url, data=body, timeout=timeout, headers={
+        "Content-Type": "application/json", "Content-Encoding": "gzip",
+    })
     r.raise_for_status()
 
 def send_metrics(server_url: str, payload: dict, timeout: int = 15) -> None:
@@ -110,75 +169,228 @@ def send_metrics(server_url: str, payload: dict, timeout: int = 15) -> None:
         raise
 
 # -------- Hashing --------
-def _iter_files(paths: Iterable[str], follow_symlinks: bool = False) -> Iterable[str]:
+def _iter_files(paths: Iterable[str], follow_symlinks: bool = False) -> Iterable[os.DirEntry]:
+    # scandir instead of os.walk: the DirEntry already knows its type and, on Windows, its stat
     for base in paths:
         base = os.path.expanduser(base)
         if not os.path.isdir(base):
             continue
-        for root, _, files in os.walk(base, followlinks=follow_symlinks):
-            for name in files:
-                yield os.path.join(root, name)
+        stack = [base]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                if follow_symlinks or not entry.is_symlink():
+                                    stack.append(entry.path)
+                            elif entry.is_file():
+                                yield entry
+                        except OSError:
+                            continue
+            except OSError:
+                continue  # unreadable directory, same as os.walk without onerror
+
+def _ts_to_iso_utc(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+
+class HashCache:
+    """LRU of path -> [size, mtime_ns, ctime_ns, dev, inode, sha256], persisted as JSON between runs.
+
+    A file whose key is unchanged is not read again. mtime alone is not enough: cp -p,
+    touch -r and tar x rewrite a file in place and restore its mtime. ctime cannot be set
+    from user space and changes on every write.
+    """
+    def __init__(self, path: str, max_entries: int = 100_000):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("[test-agent] ignoring unreadable hash cache:", e)
+
+    @staticmethod
+    def key(st: os.stat_result) -> list:
+        # scandir's stat on Windows has no dev/inode (always 0), and st_ctime there is the
+        # creation time, so Windows keeps the size + mtime key
+        if os.name == "nt":
+            return [st.st_size, st.st_mtime_ns, 0, 0]
+        return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_dev, st.st_ino]
+
+    def get(self, fp: str, st: os.stat_result) -> Optional[str]:
+        with self._lock:
+            hit = self._entries.get(fp)
+            if hit is None or hit[:-1] != self.key(st):
+                return None
+            self._entries.move_to_end(fp)
+            return hit[-1]
+
+    def put(self, fp: str, st: os.stat_result, sha: str) -> None:
+        with self._lock:
+            self._entries[fp] = self.key(st) + [sha]
+            self._entries.move_to_end(fp)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        """Atomic write: temp file, then os.replace."""
+        with self._lock:
+            data = list(self._entries.items())
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            print("[test-agent] hash cache save failed:", e)
+
+# O_SEQUENTIAL exists only on Windows, where the CRT maps it to FILE_FLAG_SEQUENTIAL_SCAN
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, "O_BINARY", 0) | getattr(os, "O_SEQUENTIAL", 0)
+
+def _fadvise(fd: int, advice_name: str) -> None:
+    advice = getattr(os, advice_name, None)
+    if advice is not None:
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+def _utf8_text(s: str) -> str:
+    """Undecodable file names (lone surrogates) -> valid UTF-8 text with \\xNN for the bad bytes."""
+    try:
+        s.encode("utf-8")
+        return s
+    except UnicodeEncodeError:
+        pass
+    try:
+        raw = s.encode("utf-8", "surrogateescape")  # POSIX: the original undecodable bytes
+    except UnicodeEncodeError:
+        raw = s.encode("utf-8", "surrogatepass")  # Windows: unpaired UTF-16 surrogates
+    return raw.decode("utf-8", "backslashreplace")
 
-def _hash_file(fp: str, max_size_bytes: Optional[int]) -> Tuple[str, Optional[str], Optional[int], Optional[str]]:
+def _hash_file(entry: os.DirEntry, max_size_bytes: Optional[int], cache: Optional[HashCache] = None) -> dict:
+    fp = entry.path
+    sha = size = mtime = err = None
     try:
-        st = os.stat(fp)
+        st = entry.stat()  # cached after the first call; size, mtime and the sort key share it
         size = int(st.st_size)
+        mtime = _ts_to_iso_utc(st.st_mtime)
         if max_size_bytes is not None and size > max_size_bytes:
-            return (fp, None, size, "size_exceeds_limit")
-        h = hashlib.sha256()
-        with open(fp, "rb", buffering=1024 * 1024) as f:
-            for chunk in iter(lambda: f.read(1024 * 1024), b""):
-                h.update(chunk)
-        return (fp, h.hexdigest(), size, None)
+            err = "size_exceeds_limit"
+        elif cache and (sha := cache.get(fp, st)):
+            pass  # unchanged since the last scan; no open, no read
+        else:
+            # unbuffered: file_digest() reads straight into its own buffer, without the GIL
+            with open(os.open(fp, _OPEN_FLAGS), "rb", buffering=0) as f:
+                _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+                if hasattr(hashlib, "file_digest"):  # Python 3.11+
+                    sha = hashlib.file_digest(f, "sha256").hexdigest()
+                else:
+                    h = hashlib.sha256()
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        h.update(chunk)
+                    sha = h.hexdigest()
+                # read once: drop the pages so a scan does not evict everything else from the cache
+                _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+            if cache:
+                cache.put(fp, st, sha)
     except Exception as e:
-        try:
-            size = int(os.path.getsize(fp))
-        except Exception:
-            size = None
-        return (fp, None, size, str(e)[:200])
+        err = str(e)[:200]
+    return {
+        "file_path": _utf8_text(fp),
+        "sha256": sha,
+        "size": size,
+        "mtime": mtime,
+        "error": _utf8_text(err) if err else err
+    }
 
-def _ts_to_iso_utc(ts: float) -> str:
-    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat()
+def _size_or_zero(entry: os.DirEntry) -> int:
+    try:
+        return entry.stat().st_size
+    except OSError:
+        return 0
 
-def collect_file_hashes(
-    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int
-) -> List[dict]:
+def iter_file_hashes(
+    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int,
+    parallel_threshold_bytes: int = 64 * 1024, cache: Optional[HashCache] = None
+) -> Iterator[dict]:
+    """Yields one record per file as it is hashed, so callers never hold the whole scan."""
     max_size_bytes = None if max_size_mb is None or max_size_mb < 0 else max_size_mb * 1024 * 1024
-    files = []
-    for i, fp in enumerate(_iter_files(dirs, follow_symlinks=follow_symlinks), start=1):
-        files.append(fp)
-        if max_files and i >= max_files:
-            break
-
-    results: List[dict] = []
+    files = list(islice(_iter_files(dirs, follow_symlinks=follow_symlinks), max(max_files or 0, 0) or None))
     if not files:
-        return results
+        return
 
+    # largest first, so one big file doesn't start last and leave the other workers idle
+    files.sort(key=_size_or_zero, reverse=True)
+    # oversized files sort to the front; their size_exceeds_limit records need no pool and no open()
+    first = 0 if max_size_bytes is None else next(
+        (i for i, e in enumerate(files) if _size_or_zero(e) <= max_size_bytes), len(files))
+    for entry in files[:first]:
+        yield _hash_file(entry, max_size_bytes)
+    # files below the threshold hash faster than a pool round-trip; do them here while the pool works
+    split = next((i for i, e in enumerate(files) if _size_or_zero(e) < parallel_threshold_bytes), len(files))
+    split = max(split, first)
     with ThreadPoolExecutor(max_workers=max(1, workers)) as ex:
-        futures = {ex.submit(_hash_file, fp, max_size_bytes): fp for fp in files}
+        futures = [ex.submit(_hash_file, entry, max_size_bytes, cache) for entry in files[first:split]]
+        for entry in files[split:]:
+            yield _hash_file(entry, max_size_bytes, cache)
         for fut in as_completed(futures):
-            fp, sha, size, err = fut.result()
-            try:
-                mtime = _ts_to_iso_utc(os.path.getmtime(fp))
-            except Exception:
-                mtime = None
-            results.append({
-                "file_path": fp,
-                "sha256": sha,
-                "size": size,
-                "mtime": mtime,
-                "error": err
-            })
-    return results
-
-def send_hashes(server_url: str, hostname: str, hashes: List[dict], timeout: int = 60, chunk_size: int = 1500) -> None:
+            yield fut.result()
+    if cache:
+        cache.save()
+
+def collect_file_hashes(
+    dirs: List[str], max_size_mb: int, max_files: Optional[int], follow_symlinks: bool, workers: int,
+    parallel_threshold_bytes: int = 64 * 1024, cache: Optional[HashCache] = None
+) -> List[dict]:
+    return list(iter_file_hashes(dirs, max_size_mb, max_files, follow_symlinks, workers,
+                                 parallel_threshold_bytes, cache))
+
+def _post_batch(url: str, hostname: str, batch: List[dict], timeout: int) -> int:
+    _post_json(url, {"hostname": hostname, "hashes": batch}, timeout)
+    return len(batch)
+
+def send_hashes(server_url: str, hostname: str, hashes: Iterable[dict], timeout: int = 60, chunk_size: int = 1500) -> int:
+    """Posts hashes in chunk_size batches; accepts a generator and returns how many were sent.
+
+    Each batch is posted from a single upload thread while the next one is being hashed, so
+    at most two batches are resident and wall time is roughly max(hashing, upload).
+    """
     url = server_url.rstrip("/") + "/collect-hashes"
-    for i in range(0, len(hashes), chunk_size):
-        batch = hashes[i:i+chunk_size]
-        r = requests.post(url, json={"hostname": hostname, "hashes": batch}, timeout=timeout)
-        r.raise_for_status()
+    sent = 0
+    it = iter(hashes)
+    pending: Optional[Future] = None
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload") as up:
+        while batch := list(islice(it, chunk_size)):
+            if pending:
+                sent += pending.result()  # re-raises the previous batch's HTTP error
+            pending = up.submit(_post_batch, url, hostname, batch, timeout)
+        if pending:
+            sent += pending.result()
+    return sent
 
 # -------- Runner --------
+def _do_hash_scan(args: argparse.Namespace, hostname: str, cache: Optional[HashCache]) -> None:
+    try:
+        print(f"[test-agent] hashing {len(args.hash_dirs)} dir(s): {args.hash_dirs}")
+        hashes = iter_file_hashes(
+            dirs=args.hash_dirs,
+            max_size_mb=args.max_size_mB if hasattr(args, "max_size_mB") else args.max_size_mb,  # tolerate typo if present
+            max_files=args.max_files,
+            follow_symlinks=False,
+            workers=args.workers,
+            cache=cache
+        )
+        sent = send_hashes(args.server, hostname, hashes)
+        print(f"[test-agent] HASH OK ({sent} entries)" if sent else "[test-agent] HASH OK (empty)")
+    except Exception as e:
+        print("[test-agent] HASH ERROR:", e)
+
 def main():
     parser = argparse.ArgumentParser(description="Local test agent (sends metrics/hashes from this machine).")
     parser.add_argument("--server", default=os.getenv("SERVER_URL", "http://localhost:8000"))
@@ -189,6 +401,8 @@ def main():
     parser.add_argument("--max-size-mb", type=int, default=int(os.getenv("AGENT_MAX_SIZE_MB", "50")))
     parser.add_argument("--max-files", type=int, default=int(os.getenv("AGENT_MAX_FILES", "500")))
     parser.add_argument("--workers", type=int, default=int(os.getenv("AGENT_WORKERS", "2")))
+    parser.add_argument("--hash-cache", default=os.getenv("HASH_CACHE", "~/.server_monitoring_test_hash_cache.json"),
+                        help="JSON cache of unchanged files' hashes between scans; empty string disables")
     parser.add_argument("--once", action="store_true", help="Send one metrics sample and (optional) one hash scan, then exit.")
     args = parser.parse_args()
 
@@ -200,7 +414,8 @@ def main():
         else:
             args.hash_dirs = [os.path.expanduser("~")]
 
-    hostname = socket.gethostname()
+    hostname = _HOSTNAME
+    cache = HashCache(args.hash_cache) if args.hash_enable and args.hash_cache else None
 
     print(f"[test-agent] server: {args.server}")
     print(f"[test-agent] metrics interval: {args.metrics_interval}s")
@@ -209,6 +424,7 @@ def main():
         print("[test-agent] psutil not available; sending partial metrics only.")
 
     last_hash_ts = 0.0
+    hash_thread: Optional[threading.Thread] = None
     while True:
         # send metrics
         try:
@@ -219,29 +435,18 @@ def main():
         except Exception as e:
             print("[test-agent] METRICS ERROR:", e)
 
-        # maybe send hashes
+        # maybe start a hash scan; it runs beside the metrics loop so a long scan doesn't delay samples
         now = time.time()
-        if args.hash_enable and (args.once or (now - last_hash_ts >= args.hash_interval)):
-            try:
-                print(f"[test-agent] hashing {len(args.hash_dirs)} dir(s): {args.hash_dirs}")
-                hashes = collect_file_hashes(
-                    dirs=args.hash_dirs,
-                    max_size_mb=args.max_size_mB if hasattr(args, "max_size_mB") else args.max_size_mb,  # tolerate typo if present
-                    max_files=args.max_files,
-                    follow_symlinks=False,
-                    workers=args.workers
-                )
-                print(f"[test-agent] collected {len(hashes)} entries; sending...")
-                if hashes:
-                    send_hashes(args.server, hostname, hashes)
-                    print("[test-agent] HASH OK")
-                else:
-                    print("[test-agent] HASH OK (empty)")
-            except Exception as e:
-                print("[test-agent] HASH ERROR:", e)
+        due = args.once or (now - last_hash_ts >= args.hash_interval)
+        if args.hash_enable and due and not (hash_thread and hash_thread.is_alive()):
+            hash_thread = threading.Thread(target=_do_hash_scan, args=(args, hostname, cache),
+                                           name="hash-scan", daemon=True)
+            hash_thread.start()
             last_hash_ts = now
 
         if args.once:
+            if hash_thread:
+                hash_thread.join()
             break
         time.sleep(max(1, int(args.metrics_interval)))
 